@@ -1,28 +1,64 @@
+import atexit
+import codecs
 import configparser
-import json
+import functools
+import itertools
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import sqlite3
+import statistics
 import sys
 import time
 import typing
-from datetime import datetime as dt
-from json.decoder import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from html.parser import HTMLParser
 
-import bs4
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from discordlogger.discordhandler import DiscordHandler
 
 last_changes_file = "last_changes.json"
-
-
-# Load config
-def load_config():
+backoff_state_file = "backoff_state.json"
+webhook_queue_file = "webhook_queue.db"
+max_delivery_attempts = 10
+update_history_length = 50
+# Only this script writes the last changes file, keep its content in
+# memory and just compare the mtime when running in a loop
+last_changes_cache = {"data": None, "mtime": 0}
+# check_last_test_time warns if the last check is older than this
+stale_check_threshold = 3600
+min_poll_delay = 60
+# Stay clearly below the stale check threshold, the timestamp is written
+# before the delay starts and the next check needs a request first
+max_poll_delay = stale_check_threshold - 5 * 60
+default_polls_per_day = 48
+# Rest of the arcdps page that is still read after the changelog so the
+# connection can be reused for the checksum request
+max_drain_size = 64 * 1024
+
+# Shared session so requests to the same host reuse their connection
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+@functools.lru_cache(maxsize=4)
+def parse_config(path: str, mtime: int) -> configparser.ConfigParser:
     config = configparser.ConfigParser()
-    with open("config.ini", encoding="utf-8") as f:
+    with open(path, encoding="utf-8") as f:
         config.read_file(f)
     return config
 
 
+# Load config, the file is only parsed again after it was modified
+def load_config() -> configparser.ConfigParser:
+    return parse_config("config.ini", os.stat("config.ini").st_mtime_ns)
+
+
 config = load_config()
 
 
@@ -38,67 +74,246 @@ def setup_logging():
     fh = logging.FileHandler("arcdps_updater.log", encoding="utf-8")
     fh.setFormatter(formatter)
     fh.setLevel(logging.INFO)
+    logger.addHandler(ch)
+    logger.addHandler(fh)
     if config.getboolean("LOGGING", "enable_discord_logging"):
         dh = DiscordHandler(logger.name + "Log",
                             config["LOGGING"]["webhook_url"])
         dh.setFormatter(formatter)
         dh.setLevel(logging.WARNING)
-    logger.addHandler(ch)
-    logger.addHandler(fh)
-    logger.addHandler(dh)
+        # Post log messages to discord from a background thread so
+        # logging never blocks on the webhook request
+        log_queue = queue.Queue(-1)
+        qh = logging.handlers.QueueHandler(log_queue)
+        qh.setLevel(logging.WARNING)
+        logger.addHandler(qh)
+        listener = logging.handlers.QueueListener(
+            log_queue, dh, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
     return logger
 
 
 logger = setup_logging()
 
 
+# Seconds to wait after the given number of consecutive failures
+def backoff_delay(failures: int) -> float:
+    return min(60, 5 * 1.3 ** failures) * 60
+
+
+def load_backoff_state() -> typing.Dict:
+    try:
+        with open(backoff_state_file, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {"consecutive_failures": 0, "next_allowed_at": 0}
+
+
+def record_request_failure():
+    failures = load_backoff_state()["consecutive_failures"] + 1
+    with open(backoff_state_file, "wb") as f:
+        f.write(orjson.dumps({
+            "consecutive_failures": failures,
+            "next_allowed_at": time.time() + backoff_delay(failures)}))
+
+
+def reset_backoff():
+    try:
+        os.remove(backoff_state_file)
+    except FileNotFoundError:
+        pass
+
+
+# GET request that backs off exponentially after failed requests, the
+# state is kept on disk so it carries over between runs. Streamed
+# responses only count as successful once the caller read the body and
+# called reset_backoff.
+def get_with_backoff(url: str, **kwargs) -> requests.Response:
+    backoff_state = load_backoff_state()
+    if time.time() < backoff_state["next_allowed_at"]:
+        logger.debug("Backing off after failed requests, exiting...")
+        sys.exit(0)
+    try:
+        response = session.get(url, timeout=5, **kwargs)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        record_request_failure()
+        raise
+    if backoff_state["consecutive_failures"] and not kwargs.get("stream"):
+        reset_backoff()
+    return response
+
+
+# Conditional request headers from the last downloaded website version
+def cache_headers(last_changes_data: typing.Dict) -> typing.Dict[str, str]:
+    headers = {}
+    if last_changes_data.get("etag"):
+        headers["If-None-Match"] = last_changes_data["etag"]
+    if last_changes_data.get("last_modified"):
+        headers["If-Modified-Since"] = last_changes_data["last_modified"]
+    return headers
+
+
 #  Retrieve arcdps website content
-def download_website_content() -> requests.Response:
+# Returns None if the website did not change since the last check
+def download_website_content(headers: typing.Dict[str, str]) \
+        -> typing.Optional[requests.Response]:
     arcdps_url = "https://www.deltaconnected.com/arcdps/"
     try:
-        response = requests.get(arcdps_url, timeout=5)
-        response.raise_for_status()
+        response = get_with_backoff(arcdps_url, stream=True,
+                                    headers=headers)
     except requests.exceptions.Timeout:
         logger.critical("Request to arcdps website timed out")
         sys.exit(1)
-    except requests.exceptions.HTTPError:
+    except requests.exceptions.HTTPError as e:
         logger.critical("Request return code was not OK "
-                        + f"({response.status_code})")
+                        + f"({e.response.status_code})")
         sys.exit(1)
+    if response.status_code == 304:
+        # Consume the empty body so the connection goes back to the pool
+        response.content
+        return None
     return response
 
 
+# Collects the <br> separated lines between the "changes" and "download"
+# headings while the page is fed in, without building a document tree
+class ChangesParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.changelog = []
+        self.collecting = False
+        self.done = False
+        self.in_heading = False
+        self.heading = []
+        self.line = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "b":
+            self.in_heading = True
+            self.heading = []
+        elif tag == "br" and self.collecting:
+            self.end_line()
+
+    def handle_endtag(self, tag):
+        if tag != "b" or not self.in_heading:
+            return
+        self.in_heading = False
+        heading = "".join(self.heading).strip()
+        if heading == "changes" and not self.done:
+            self.collecting = True
+        elif heading == "download" and self.collecting:
+            self.end_line()
+            self.collecting = False
+            self.done = True
+        elif self.collecting:
+            # Bold text inside a changelog line
+            self.line.append(heading)
+
+    def handle_data(self, data):
+        if self.in_heading:
+            self.heading.append(data)
+        elif self.collecting:
+            self.line.append(data)
+
+    def end_line(self):
+        line = "".join(self.line).strip()
+        if line:
+            self.changelog.append(line)
+        self.line = []
+
+
 def parse_html(response: requests.Response) -> typing.List[str]:
-    soup = bs4.BeautifulSoup(response.content, features="html.parser")
-    soup = soup.find("b", string="changes")
-    changelog = []
-    for element in soup.next_elements:
-        element_string = element.string
-        if element_string is not None:
-            changelog.append(element.string.strip())
-        if element.name == "b" and element.string == "download":
-            break
-    # remove "changes", "downloads" and a newline from list
-    changelog = changelog[1:-2]
-    return changelog
-
-
-def write_last_changes(changelog: typing.List[str]):
+    # The changelog is at the top of the page, stop reading once it is
+    # complete instead of downloading the whole page
+    parser = ChangesParser()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    with response:
+        try:
+            for chunk in response.iter_content(8192):
+                parser.feed(decoder.decode(chunk))
+                if parser.done:
+                    break
+        except requests.exceptions.RequestException:
+            logger.exception("Reading the arcdps website failed")
+            record_request_failure()
+            sys.exit(1)
+        reset_backoff()
+        # Closing a partially read response drops the socket, the checksum
+        # request would then need a new TCP and TLS handshake. Finish
+        # reading if the rest is small, large or unknown sized rests are
+        # still cut off to save the download.
+        try:
+            remaining = int(response.headers.get("Content-Length", -1)) \
+                - response.raw.tell()
+        except ValueError:
+            remaining = -1
+        if 0 < remaining <= max_drain_size:
+            try:
+                for _ in response.iter_content(8192):
+                    pass
+            except requests.exceptions.RequestException:
+                # The changelog is complete, the connection is just not
+                # reused
+                pass
+    if not parser.done:
+        logger.critical("Could not find the changelog on the arcdps website")
+        sys.exit(1)
+    return parser.changelog
+
+
+def read_last_changes() -> typing.Dict:
+    mtime = os.stat(last_changes_file).st_mtime_ns
+    if last_changes_cache["data"] is None \
+            or last_changes_cache["mtime"] != mtime:
+        with open(last_changes_file, "rb") as f:
+            last_changes_cache["data"] = orjson.loads(f.read())
+        last_changes_cache["mtime"] = mtime
+    return last_changes_cache["data"]
+
+
+def dump_last_changes(last_changes_data: typing.Dict):
+    with open(last_changes_file, "wb") as f:
+        f.write(orjson.dumps(last_changes_data))
+    last_changes_cache["data"] = last_changes_data
+    last_changes_cache["mtime"] = os.stat(last_changes_file).st_mtime_ns
+
+
+def write_last_changes(changelog: typing.List[str],
+                       response: typing.Optional[requests.Response] = None,
+                       update_history: typing.Optional[typing.List[int]]
+                       = None):
+    last_changes_data = {"changes": changelog,
+                         "timestamp": int(time.time()),
+                         "updates": update_history or []}
+    if response is not None:
+        last_changes_data["etag"] = response.headers.get("ETag")
+        last_changes_data["last_modified"] = \
+            response.headers.get("Last-Modified")
     try:
-        with open(last_changes_file, "w", encoding="utf-8") as f:
-            json.dump({"changes": changelog,
-                       "timestamp": dt.now().isoformat()}, f)
+        dump_last_changes(last_changes_data)
     except Exception:
         logger.exception(
             f"A problem occured while writing {last_changes_file}")
         sys.exit(1)
 
 
+# Refresh the last check timestamp, the stored changelog stays valid
+def touch_last_changes(last_changes_data: typing.Dict):
+    try:
+        dump_last_changes({**last_changes_data,
+                           "timestamp": int(time.time())})
+    except Exception:
+        logger.exception(
+            f"A problem occured while updating {last_changes_file}")
+        sys.exit(1)
+
+
 # Reading last changes file
 def load_last_changes(changelog: typing.List[str]):
     try:
-        with open(last_changes_file, encoding="utf-8") as f:
-            last_changes_data = json.load(f)
+        last_changes_data = read_last_changes()
         # <= tests for subset
         if not {"timestamp", "changes"} <= last_changes_data.keys():
             raise FileNotFoundError
@@ -107,7 +322,7 @@ def load_last_changes(changelog: typing.List[str]):
                        + "creating a new file. ")
         write_last_changes(changelog)
         sys.exit(1)
-    except JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.warning(f"File {last_changes_file} "
                        + "empty or corrupt, creating a new file. "
                        + "You can find the old file under "
@@ -121,26 +336,131 @@ def load_last_changes(changelog: typing.List[str]):
     return last_changes_data
 
 
-# Check if there was an arcdps update
-def test_for_update(last_changes_data: typing.Dict) -> bool:
-    last_test_timestamp = dt.fromisoformat(
-        last_changes_data["timestamp"])
-    hours_since_last_test = (
-        dt.now() - last_test_timestamp).total_seconds() / 3600
-    if hours_since_last_test > 1:
+# Warn if the script was not run for a while
+def check_last_test_time(last_changes_data: typing.Dict):
+    last_test_timestamp = last_changes_data["timestamp"]
+    if isinstance(last_test_timestamp, str):
+        # Older versions stored the timestamp in ISO format
+        last_test_timestamp = time.mktime(time.strptime(
+            last_test_timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+    seconds_since_last_test = time.time() - last_test_timestamp
+    if seconds_since_last_test > stale_check_threshold:
         logger.warning(f"Time since last update check more than "
-                       + f"{hours_since_last_test} hours! Last Update: "
-                       + f"{str(last_test_timestamp)}")
+                       + f"{seconds_since_last_test / 3600} hours! "
+                       + "Last Update: "
+                       + time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(last_test_timestamp)))
 
+
+# Check if there was an arcdps update
+def test_for_update(last_changes_data: typing.Dict,
+                    changelog: typing.List[str]) -> bool:
     return False if changelog[0] == last_changes_data["changes"][0] \
         else True
 
 
+# Timestamps of the last detected updates, oldest first
+def load_update_history() -> typing.List[int]:
+    try:
+        return read_last_changes().get("updates", [])
+    except (OSError, orjson.JSONDecodeError):
+        return []
+
+
+def gamma_pdf(x: float, shape: float, scale: float) -> float:
+    if x <= 0:
+        return 0.0
+    return math.exp((shape - 1) * math.log(x) - x / scale
+                    - math.lgamma(shape) - shape * math.log(scale))
+
+
+def gamma_cdf(x: float, shape: float, scale: float) -> float:
+    if x <= 0:
+        return 0.0
+    x /= scale
+    if x > 500:
+        return 1.0
+    # Series expansion of the regularized lower incomplete gamma function
+    term = total = 1 / shape
+    n = 0
+    while term > total * 1e-12 and n < 2000:
+        n += 1
+        term *= x / (shape + n)
+        total += term
+    return min(1.0, total * math.exp(shape * math.log(x) - x
+                                     - math.lgamma(shape)))
+
+
+# Poll times after an update, the interval shrinks with the hazard rate
+# h = p / (1 - F) as c / sqrt(h), which minimizes the expected detection
+# delay for a given expected number of polls. Also returns that number,
+# stopping early once it exceeds the budget.
+def poll_schedule(interval_scale: float, shape: float, scale: float,
+                  budget: float = math.inf) \
+        -> typing.Tuple[typing.List[float], float]:
+    schedule = []
+    poll = 0.0
+    survival = 1.0
+    expected_polls = 0.0
+    while survival > 1e-4 and expected_polls <= budget:
+        hazard = gamma_pdf(max(poll, min_poll_delay), shape, scale) \
+            / survival
+        interval = interval_scale / math.sqrt(hazard) if hazard > 0 \
+            else max_poll_delay
+        poll += min(max_poll_delay, max(min_poll_delay, interval))
+        # A poll only happens if the update was not detected before
+        expected_polls += survival
+        schedule.append(poll)
+        survival = 1 - gamma_cdf(poll, shape, scale)
+    return schedule, expected_polls
+
+
+# Poll times relative to the last update, the history only changes when
+# an update was detected so the fit is cached
+@functools.lru_cache(maxsize=4)
+def fit_poll_schedule(update_history: typing.Tuple[int, ...],
+                      polls_per_day: int) -> typing.Tuple[float, ...]:
+    gaps = [b - a for a, b in zip(update_history, update_history[1:])
+            if b > a]
+    if len(gaps) < 2 or statistics.variance(gaps) == 0:
+        return ()
+    # Method of moments fit of a gamma distribution to the update gaps
+    mean = statistics.mean(gaps)
+    variance = statistics.variance(gaps)
+    shape, scale = mean ** 2 / variance, variance / mean
+    # The schedule restarts after every update, so the daily budget is
+    # spent over the mean gap. Polls forced by max_poll_delay count too,
+    # if they alone exceed the budget the cap wins.
+    budget = polls_per_day * mean / 86400
+    low, high = math.log(1e-6), math.log(1e6)
+    for _ in range(25):
+        interval_scale = (low + high) / 2
+        if poll_schedule(math.exp(interval_scale), shape, scale,
+                         budget)[1] > budget:
+            low = interval_scale
+        else:
+            high = interval_scale
+    return tuple(poll_schedule(math.exp(high), shape, scale)[0])
+
+
+# Seconds until the next check, polling densest when updates are likely
+def next_poll_delay(update_history: typing.List[int],
+                    polls_per_day: int) -> float:
+    default_delay = min(max_poll_delay, 86400 / polls_per_day)
+    if not update_history:
+        return default_delay
+    elapsed = time.time() - update_history[-1]
+    for poll in fit_poll_schedule(tuple(update_history), polls_per_day):
+        # Allow for rounding, a poll that just happened is not due again
+        if poll > elapsed + 1:
+            return min(max_poll_delay, max(min_poll_delay, poll - elapsed))
+    return default_delay
+
+
 def get_checksum() -> str:
     url = "https://www.deltaconnected.com/arcdps/x64/d3d11.dll.md5sum"
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = get_with_backoff(url)
     except Exception:
         logger.exception("An exception occured while trying to download"
                          + "the md5 checksum")
@@ -148,10 +468,16 @@ def get_checksum() -> str:
     return response.content.decode().split()[0]
 
 
-def load_webhooks() -> str:
+@functools.lru_cache(maxsize=4)
+def parse_webhooks(path: str, mtime: int) -> typing.List[typing.Dict]:
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def load_webhooks() -> typing.List[typing.Dict]:
     try:
-        with open("webhooks.json", "r", encoding="utf-8") as f:
-            webhooks = json.load(f)
+        webhooks = parse_webhooks("webhooks.json",
+                                  os.stat("webhooks.json").st_mtime_ns)
     except Exception:
         logger.exception("An exception occured while trying to read "
                          + "the webhooks.json file.")
@@ -159,20 +485,85 @@ def load_webhooks() -> str:
     return webhooks
 
 
-# Send message(s) via Discord webhook(s)
-def send_update_message(changelog: typing.List[str],
-                        old_changelog: typing.List[str]):
-    webhooks = load_webhooks()
-    checksum = get_checksum()
-    changes = ""
-    for change in changelog:
-        if change in old_changelog:
-            break
-        else:
-            changes += change + "\n"
-
+# Returns None once the message is done, otherwise the seconds to wait
+# before retrying it (0 for the default backoff)
+def post_webhook(url: str, body: bytes) -> typing.Optional[float]:
+    try:
+        response = session.post(
+            url, data=body, headers={"Content-Type": "application/json"},
+            timeout=5)
+        response.raise_for_status()
+    except requests.exceptions.Timeout:
+        logger.error("Request to discord webhook url timed out"
+                     + f"\nID: {url}")
+        return 0.0
+    except requests.exceptions.RequestException as e:
+        logger.exception("Request to discord webhook url failed\n"
+                         + f"\nID: {url}")
+        if e.response is None:
+            return 0.0
+        status_code = e.response.status_code
+        if status_code == 429:
+            try:
+                return float(e.response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                return 0.0
+        # Other client errors won't go away by retrying
+        return None if 400 <= status_code < 500 else 0.0
+    return None
+
+
+def open_webhook_queue() -> sqlite3.Connection:
+    connection = sqlite3.connect(webhook_queue_file)
+    connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       + "id INTEGER PRIMARY KEY, url TEXT, body BLOB, "
+                       + "attempts INTEGER, next_try REAL)")
+    return connection
+
+
+# Post all queued webhook messages that are due, failed messages are
+# retried with exponential backoff on later runs
+def drain_webhook_queue():
+    # Nothing was ever queued
+    if not os.path.exists(webhook_queue_file):
+        return
+    now = time.time()
+    with closing(open_webhook_queue()) as connection:
+        jobs = connection.execute(
+            "SELECT id, url, body, attempts FROM jobs WHERE next_try <= ?",
+            (now,)).fetchall()
+        if not jobs:
+            return
+        # Webhooks are independent, so post them concurrently
+        with ThreadPoolExecutor(max_workers=min(len(jobs), 16)) as executor:
+            results = list(executor.map(post_webhook,
+                                        [job[1] for job in jobs],
+                                        [job[2] for job in jobs]))
+        with connection:
+            for (job_id, url, _, attempts), retry_after in zip(jobs, results):
+                attempts += 1
+                if retry_after is not None \
+                        and attempts >= max_delivery_attempts:
+                    logger.error("Giving up on discord webhook message "
+                                 + f"after {attempts} attempts\nID: {url}")
+                    retry_after = None
+                if retry_after is None:
+                    connection.execute("DELETE FROM jobs WHERE id = ?",
+                                       (job_id,))
+                else:
+                    connection.execute(
+                        "UPDATE jobs SET attempts = ?, next_try = ? "
+                        + "WHERE id = ?",
+                        (attempts,
+                         now + (retry_after or backoff_delay(attempts)),
+                         job_id))
+    logger.debug(f"Processed {len(jobs)} queued webhook messages")
+
+
+# Message body shared by all webhooks, only username and avatar differ
+def build_update_message(changes: str, checksum: str) -> typing.Dict:
     download_url = "https://www.deltaconnected.com/arcdps/x64/"
-    body = {
+    return {
         "content": "Ein neues ArcDPS Update ist verfügbar! "
         + ":partying_face:",
         "embeds": [{
@@ -185,42 +576,115 @@ def send_update_message(changelog: typing.List[str],
         }]
     }
 
-    for webhook in webhooks:
-        body["username"] = webhook["username"] if webhook["username"] \
-            else config["WEBHOOK"]["default_username"]
-        body["avatar_url"] = webhook["avatar_url"] if \
-            webhook["avatar_url"] else ""
 
-        try:
-            response = requests.post(webhook["url"], json=body,
-                                     timeout=5)
-            response.raise_for_status()
-        except requests.exceptions.Timeout:
-            logger.error("Request to discord webhook url timed out"
-                         + f"\nID: {webhook['url']}")
-        except requests.exceptions.HTTPError:
-            logger.exception(
-                f"Request to discord webhook url failed\n"
-                + f"\nID: {webhook['url']}")
-
-
-if __name__ == "__main__":
+# Discord webhook url and serialized message for every webhook
+def prepare_update_messages(changelog: typing.List[str],
+                            old_changelog: typing.List[str]) \
+        -> typing.List[typing.Tuple[str, bytes]]:
+    config = load_config()
+    webhooks = load_webhooks()
+    checksum = get_checksum()
+    # New changes are listed on top, stop at the first already known one
+    old_changes = set(old_changelog)
+    changes = "".join(
+        change + "\n" for change in itertools.takewhile(
+            lambda change: change not in old_changes, changelog))
+
+    body = build_update_message(changes, checksum)
+    default_username = config["WEBHOOK"]["default_username"]
+    return [(webhook["url"],
+             orjson.dumps({**body,
+                           "username": webhook["username"]
+                           or default_username,
+                           "avatar_url": webhook["avatar_url"] or ""}))
+            for webhook in webhooks]
+
+
+# Messages are delivered by drain_webhook_queue so failed posts can be
+# retried
+def queue_update_messages(messages: typing.List[typing.Tuple[str, bytes]]):
+    now = time.time()
+    with closing(open_webhook_queue()) as connection, connection:
+        connection.executemany(
+            "INSERT INTO jobs (url, body, attempts, next_try) "
+            + "VALUES (?, ?, 0, ?)",
+            [(url, body, now) for url, body in messages])
+
+
+def check_for_update():
     try:
         logger.info("Starting script...")
-        response = download_website_content()
+        # Missing or corrupt files are handled by load_last_changes once
+        # the website was downloaded unconditionally
+        try:
+            last_changes_data = read_last_changes()
+        except (OSError, orjson.JSONDecodeError):
+            last_changes_data = {}
+        response = download_website_content(cache_headers(last_changes_data))
+        if response is None:
+            # Nothing to parse, compare or send
+            logger.info("Website not modified, exiting...")
+            check_last_test_time(last_changes_data)
+            touch_last_changes(last_changes_data)
+            logger.debug("Updated last check timestamp")
+            return
         logger.debug("Downloaded website content")
         changelog = parse_html(response)
         logger.debug("Parsed website content")
         last_changes_data = load_last_changes(changelog)
         logger.debug("Loaded last changelog")
-        update_available = test_for_update(last_changes_data)
+        check_last_test_time(last_changes_data)
+        update_history = last_changes_data.get("updates", [])
+        update_available = test_for_update(last_changes_data, changelog)
         if not update_available:
             logger.info("No changes detected, exiting...")
         else:
             logger.info("New changes detected")
-            send_update_message(changelog, last_changes_data["changes"])
-            logger.info("Sent discord webhook messages")
-        write_last_changes(changelog)
+            messages = prepare_update_messages(changelog,
+                                               last_changes_data["changes"])
+            update_history = update_history + [int(time.time())]
+        write_last_changes(changelog, response,
+                           update_history[-update_history_length:])
         logger.debug("Wrote latest changes data to disk")
+        # Only queued once the new changelog is stored, otherwise a failed
+        # write would detect and queue the same update again next run
+        if update_available:
+            queue_update_messages(messages)
+            logger.info("Queued discord webhook messages")
     except Exception:
         logger.exception("Unexpected error!")
+    finally:
+        # Also retry pending messages when the check itself failed
+        try:
+            drain_webhook_queue()
+        except Exception:
+            logger.exception("Unexpected error while delivering webhook "
+                             + "messages!")
+
+
+if __name__ == "__main__":
+    if not config.getboolean("POLLING", "enable_loop", fallback=False):
+        check_for_update()
+    else:
+        delay = min(max_poll_delay, 86400 / default_polls_per_day)
+        while True:
+            try:
+                check_for_update()
+            except SystemExit:
+                # Failures are already logged, keep polling
+                pass
+            try:
+                polls_per_day = load_config().getint(
+                    "POLLING", "polls_per_day",
+                    fallback=default_polls_per_day)
+                if polls_per_day < 1:
+                    raise ValueError("polls_per_day must be at least 1, "
+                                     + f"got {polls_per_day}")
+                delay = next_poll_delay(load_update_history(), polls_per_day)
+            except Exception:
+                # A broken config.ini must not stop the poller, keep the
+                # previous delay until it is fixed
+                logger.exception("Could not determine the next poll delay, "
+                                 + f"using {delay / 60:.1f} minutes")
+            logger.debug(f"Next update check in {delay / 60:.1f} minutes")
+            time.sleep(delay)